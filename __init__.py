@@ -1,12 +1,40 @@
+import heapq
+import re
+from concurrent.futures import ThreadPoolExecutor, wait
 from os.path import join, dirname
 from ovos_workshop.skills.common_play import OVOSCommonPlaybackSkill, common_play_search
 from ovos_workshop.frameworks.playback import CommonPlayMediaType, CommonPlayPlaybackType, \
     CommonPlayMatchConfidence
-from ovos_utils.parse import fuzzy_match, MatchStrategy
+from ovos_utils.file_utils import read_vocab_file
 
+import numpy as np
+from diskcache import Cache
+from rapidfuzz import fuzz, process
 from youtube_searcher import search_youtube
 
 
+def _search_videos(query):
+    return search_youtube(query)["videos"]
+
+
+def _score_titles(phrase, titles):
+    """ token set ratio (0 - 100) of phrase against every title """
+    # single native call for all titles
+    return process.cdist([phrase], titles, scorer=fuzz.token_set_ratio,
+                         dtype=np.float64)[0]
+
+
+def _compile_vocab(vocab):
+    """ single word boundary regex matching any of the vocab entries """
+    entries = [r"\s+".join(re.escape(w) for w in v.split())
+               for v in vocab if v.strip()]
+    if not entries:
+        return re.compile(r"(?!)")  # never matches
+    # longest first so multi word entries win over their prefixes
+    entries.sort(key=len, reverse=True)
+    return re.compile(r"\b(?:%s)\b" % "|".join(entries), re.IGNORECASE)
+
+
 class SimpleYoutubeSkill(OVOSCommonPlaybackSkill):
     def __init__(self):
         super(SimpleYoutubeSkill, self).__init__("Simple Youtube")
@@ -15,7 +43,6 @@ class SimpleYoutubeSkill(OVOSCommonPlaybackSkill):
                                 CommonPlayMediaType.PODCAST,
                                 CommonPlayMediaType.DOCUMENTARY,
                                 CommonPlayMediaType.VIDEO]
-        self._search_cache = {}
         self.skill_icon = join(dirname(__file__), "ui", "ytube.jpg")
         if "fallback_mode" not in self.settings:
             self.settings["fallback_mode"] = False
@@ -23,6 +50,47 @@ class SimpleYoutubeSkill(OVOSCommonPlaybackSkill):
             self.settings["audio_only"] = False
         if "video_only" not in self.settings:
             self.settings["video_only"] = True
+        if "max_results" not in self.settings:
+            self.settings["max_results"] = 10
+        if "search_cache_ttl" not in self.settings:
+            self.settings["search_cache_ttl"] = 3600
+        if "search_timeout" not in self.settings:
+            self.settings["search_timeout"] = 15
+        # on disk cache with expiration, results survive restarts
+        # bounded with LRU eviction, failed searches raise and are never cached
+        self._disk_cache = Cache(join(dirname(__file__), ".cache"),
+                                 eviction_policy="least-recently-used",
+                                 size_limit=64 * 1024 * 1024)
+        self._search_cache = self._disk_cache.memoize(
+            expire=self.settings["search_cache_ttl"])(_search_videos)
+        self._voc_regex_cache = {}
+        # several workers so a slow search does not hold up other queries
+        self._search_executor = ThreadPoolExecutor(max_workers=4)
+        self._searches = set()  # in flight searches
+
+    def shutdown(self):
+        # drop queued searches, give running ones up to search_timeout to
+        # finish before closing the cache they write into
+        self._search_executor.shutdown(wait=False, cancel_futures=True)
+        wait(list(self._searches), timeout=self.settings["search_timeout"])
+        self._disk_cache.close()
+        super(SimpleYoutubeSkill, self).shutdown()
+
+    def _voc_regex(self, voc_filename):
+        """ compiled matcher for a .voc file, built once per lang """
+        cache_key = self.lang + voc_filename
+        if cache_key not in self._voc_regex_cache:
+            vocab = []
+            path = self.find_resource(voc_filename + ".voc", "vocab")
+            if path:
+                # list of expanded alternatives per line
+                vocab = [v for line in read_vocab_file(path) for v in line]
+            else:
+                self.log.warning("%s.voc not found for %s, "
+                                 "nothing will match it",
+                                 voc_filename, self.lang)
+            self._voc_regex_cache[cache_key] = _compile_vocab(vocab)
+        return self._voc_regex_cache[cache_key]
 
     # common play
     @common_play_search()
@@ -52,11 +120,21 @@ class SimpleYoutubeSkill(OVOSCommonPlaybackSkill):
             base_score += 25
 
         explicit_request = False
-        if self.voc_match(phrase, "youtube"):
+        youtube_voc = self._voc_regex("youtube")
+        if youtube_voc.search(phrase):
             # explicitly requested youtube
             base_score += 50
-            phrase = self.remove_voc(phrase, "youtube")
+            phrase = " ".join(youtube_voc.sub(" ", phrase).split())
             explicit_request = True
+        phrase_lc = phrase.lower()
+
+        # search youtube, cache results for speed in repeat queries
+        # normalize case and whitespace so near duplicate phrases hit cache
+        # the search runs in the background while we prepare everything else
+        query = " ".join(phrase_lc.split())
+        search = self._search_executor.submit(self._search_cache, query)
+        self._searches.add(search)
+        search.add_done_callback(self._searches.discard)
 
         # playback_type defines if results should be VIDEO / AUDIO / AUDIO + VIDEO
         # this could be done at individual match level instead if needed
@@ -68,150 +146,163 @@ class SimpleYoutubeSkill(OVOSCommonPlaybackSkill):
         else:
             playback = [CommonPlayPlaybackType.VIDEO]
 
-        # search youtube, cache results for speed in repeat queries
-        if phrase in self._search_cache:
-            results = self._search_cache[phrase]
-        else:
-            try:
-                results = search_youtube(phrase)["videos"]
-            except Exception as e:
-                # youtube can break at any time... they also love AB testing
-                # often only some queries will break...
-                self.log.error("youtube search failed!")
-                self.log.exception(e)
-                return []
-            self._search_cache[phrase] = results
+        # compile vocabs once instead of calling voc_match per result,
+        # each title is then scanned a single time per vocab
+        music_voc = self._voc_regex("music")
+        podcast_voc = self._voc_regex("podcast")
+        documentary_voc = self._voc_regex("documentary")
+
+        try:
+            results = search.result(timeout=self.settings["search_timeout"])
+        except Exception as e:
+            # youtube can break at any time... they also love AB testing
+            # often only some queries will break... or hang, hence the timeout
+            self.log.error("youtube search failed!")
+            self.log.exception(e)
+            return []
 
         # filter results
         def parse_duration(video):
             # parse duration into (int) seconds
             # {'length': '3:49'
-            if not video.get("length"):
-                return 0
             length = 0
-            nums = video["length"].split(":")
-            if len(nums) == 1 and nums[0].isdigit():
-                # seconds
-                length = int(nums[0])
-            elif len(nums) == 2:
-                # minutes : seconds
-                length = int(nums[0]) * 60 + \
-                         int(nums[0])
-            elif len(nums) == 3:
-                # hours : minutes : seconds
-                length = int(nums[0]) * 60 * 60 + \
-                         int(nums[0]) * 60 + \
-                         int(nums[0])
+            try:
+                # [[hours :] minutes :] seconds
+                for num in (video.get("length") or "").split(":"):
+                    length = length * 60 + int(num)
+            except ValueError:
+                length = 0
             # better-common_play expects milliseconds
             return length * 1000
 
-        def is_music(match):
-            return self.voc_match(match["title"], "music")
-
-        def is_podcast(match):
-            # lets require duration above 30min to exclude trailers and such
-            dur = parse_duration(match) / 1000  # convert ms to seconds
-            if dur < 30 * 60:
-                return False
-            return self.voc_match(match["title"], "podcast")
+        # split results into columns in a single pass,
+        # filtering and scoring work on these instead of the result dicts
+        icon = self.skill_icon
+        titles, urls, images, lengths = [], [], [], []
+        for r in results:
+            titles.append(r["title"])
+            urls.append(r["url"])
+            # last thumbnail is the highest resolution, used for image
+            # and bg_image of both the video and audio only matches
+            thumbnails = r.get("thumbnails")
+            images.append(thumbnails[-1]["url"].partition("?")[0]
+                          if thumbnails else icon)
+            lengths.append(parse_duration(r))
+        lengths = np.array(lengths, dtype=np.int64)
 
-        def is_documentary(match):
-            # lets require duration above 20min to exclude trailers and such
-            dur = parse_duration(match) / 1000  # convert ms to seconds
-            if dur < 20 * 60:
-                return False
-            return self.voc_match(match["title"], "documentary")
+        def is_music(title):
+            return music_voc.search(title) is not None
 
+        keep = np.ones(len(titles), dtype=bool)
         if media_type == CommonPlayMediaType.MUSIC:
             # only return videos assumed to be music
             # music.voc contains things like "full album" and "music"
             # if any of these is present in the title, the video is valid
-            results = [r for r in results if is_music(r)]
+            keep &= np.fromiter((is_music(t) for t in titles),
+                                dtype=bool, count=len(titles))
 
         if media_type == CommonPlayMediaType.PODCAST:
             # only return videos assumed to be podcasts
+            # lets require duration above 30min to exclude trailers and such
             # podcast.voc contains things like "podcast"
-            results = [r for r in results if is_podcast(r)]
+            keep &= lengths >= 30 * 60 * 1000
+            keep &= np.fromiter((k and podcast_voc.search(t) is not None
+                                 for k, t in zip(keep, titles)),
+                                dtype=bool, count=len(titles))
 
         if media_type == CommonPlayMediaType.DOCUMENTARY:
             # only return videos assumed to be documentaries
-            # podcast.voc contains things like "documentary"
-            results = [r for r in results if is_documentary(r)]
+            # lets require duration above 20min to exclude trailers and such
+            # documentary.voc contains things like "documentary"
+            keep &= lengths >= 20 * 60 * 1000
+            keep &= np.fromiter((k and documentary_voc.search(t) is not None
+                                 for k, t in zip(keep, titles)),
+                                dtype=bool, count=len(titles))
+
+        if not keep.all():
+            idxs = np.flatnonzero(keep)
+            titles = [titles[i] for i in idxs]
+            urls = [urls[i] for i in idxs]
+            images = [images[i] for i in idxs]
+            lengths = lengths[idxs]
 
         # score
-        def calc_score(match, idx=0):
-            # idx represents the order from youtube
-            score = base_score - idx * 5 # - 5% as we go down the results list
+        # youtube gives pretty high scores in general, so we allow it
+        # to run as fallback mode, which assigns lower scores and gives
+        # preference to matches from other skills
+        fallback = self.settings["fallback_mode"] and not explicit_request
 
+        def calc_scores(start, stop):
+            # score results[start:stop] at once
+            # idx represents the order from youtube
+            # - 5% as we go down the results list
+            scores = base_score - 5 * np.arange(start, stop, dtype=np.float64)
+            # fuzzy match all titles in a single call
             # this will give score of 100 if query is included in video title
-            score += 100 * fuzzy_match(
-                phrase.lower(), match["title"].lower(),
-                strategy=MatchStrategy.TOKEN_SET_RATIO)
-
+            scores += _score_titles(
+                phrase_lc, [t.lower() for t in titles[start:stop]])
             # small penalty to not return 100 and allow better disambiguation
             if media_type == CommonPlayMediaType.GENERIC:
-                score -= 10
-            if score >= 100:
-                if media_type == CommonPlayMediaType.AUDIO:
-                    score -= 20  # likely don't want to answer most of these
-                elif media_type != CommonPlayMediaType.VIDEO:
-                    score -= 10
-                elif media_type == CommonPlayMediaType.MUSIC and not is_music(match):
-                    score -= 5
-
-            # youtube gives pretty high scores in general, so we allow it
-            # to run as fallback mode, which assigns lower scores and gives
-            # preference to matches from other skills
-            if self.settings["fallback_mode"]:
-                if not explicit_request:
-                    score -= 25
-            return min(100, score)
-
-        matches = []
-        if self.settings["audio_only"]:
+                scores -= 10
+            if media_type == CommonPlayMediaType.AUDIO:
+                scores[scores >= 100] -= 20  # likely don't want to answer most of these
+            elif media_type != CommonPlayMediaType.VIDEO:
+                scores[scores >= 100] -= 10
+            if fallback:
+                scores -= 25
+            return np.minimum(scores, 100)
+
+        # common play only needs the best few matches to disambiguate
+        max_results = self.settings["max_results"]
+        scores = calc_scores(0, min(max_results, len(titles)))
+        if len(titles) > max_results > 0:
+            # the best a later result can score is a perfect fuzzy match
+            # minus the flat penalties and 5 per position, once that drops
+            # below the worst score already in the top results it can not
+            # make the cut, so fuzzy matching it is skipped
+            best = base_score + 100
+            if media_type == CommonPlayMediaType.GENERIC:
+                best -= 10
+            if fallback:
+                best -= 25
+            stop = int((best - scores.min()) // 5) + 1
+            stop = min(len(titles), stop)
+            if stop > max_results:
+                scores = np.concatenate(
+                    [scores, calc_scores(max_results, stop)])
+
+        # (score, duration_ms, image_url, title, url) for every scored result
+        scored = zip(scores.tolist(), lengths.tolist(), images, titles, urls)
+        scored = heapq.nlargest(max_results, scored, key=lambda s: s[0])
+
+        audio_only = self.settings["audio_only"]
+        # static fields are shared by every match, only copy them per result
+        template = {
+            "media_type": CommonPlayMediaType.VIDEO,
+            "playback": CommonPlayPlaybackType.AUDIO if audio_only
+            else CommonPlayPlaybackType.VIDEO,
+            "skill_icon": icon,
+            "skill_logo": icon,  # backwards compat
+            "skill_id": self.skill_id
+        }
+        suffix = " (audio only)" if audio_only else ""
+        matches = [dict(template,
+                        match_confidence=score,
+                        length=length,
+                        uri=url,
+                        image=image,
+                        bg_image=image,
+                        title=title + suffix)
+                   for score, length, image, title, url in scored]
+
+        if not audio_only and not self.settings["video_only"]:
+            # add audio only duplicate results
             matches += [{
-                "match_confidence": calc_score(r, idx),
-                "media_type": CommonPlayMediaType.VIDEO,
-                "length": parse_duration(r),
-                "uri": r["url"],
+                **m,
+                "match_confidence": m["match_confidence"] - 1,
                 "playback": CommonPlayPlaybackType.AUDIO,
-                "image": r["thumbnails"][-1]["url"].split("?")[0],
-                "bg_image": r["thumbnails"][-1]["url"].split("?")[0],
-                "skill_icon": self.skill_icon,
-                "skill_logo": self.skill_icon,  # backwards compat
-                "title": r["title"] + " (audio only)",
-                "skill_id": self.skill_id
-            } for idx, r in enumerate(results)]
-        else:
-            matches += [{
-                "match_confidence": calc_score(r, idx),
-                "media_type": CommonPlayMediaType.VIDEO,
-                "length": parse_duration(r),
-                "uri": r["url"],
-                "playback": CommonPlayPlaybackType.VIDEO,
-                "image": r["thumbnails"][-1]["url"].split("?")[0],
-                "bg_image": r["thumbnails"][-1]["url"].split("?")[0],
-                "skill_icon": self.skill_icon,
-                "skill_logo": self.skill_icon,  # backwards compat
-                "title": r["title"],
-                "skill_id": self.skill_id
-            } for idx, r in enumerate(results)]
-
-            if not self.settings["video_only"]:
-                # add audio only duplicate results
-                matches += [{
-                    "match_confidence": calc_score(r, idx) - 1,
-                    "media_type": CommonPlayMediaType.VIDEO,
-                    "length": parse_duration(r),
-                    "uri": r["url"],
-                    "playback": CommonPlayPlaybackType.AUDIO,
-                    "image": r["thumbnails"][-1]["url"].split("?")[0],
-                    "bg_image": r["thumbnails"][-1]["url"].split("?")[0],
-                    "skill_icon": self.skill_icon,
-                    "skill_logo": self.skill_icon,  # backwards compat
-                    "title": r["title"] + " (audio only)",
-                    "skill_id": self.skill_id
-                } for idx, r in enumerate(results)]
+                "title": m["title"] + " (audio only)"
+            } for m in matches]
 
         return matches
 
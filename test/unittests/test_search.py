@@ -0,0 +1,50 @@
+import importlib.util
+import sys
+import unittest
+from os.path import dirname, join
+from unittest.mock import MagicMock
+
+from ovos_workshop.frameworks.playback import CommonPlayMediaType
+
+# the skill lives in the repo root __init__.py
+SKILL_DIR = dirname(dirname(dirname(__file__)))
+_spec = importlib.util.spec_from_file_location(
+    "skill_simple_youtube", join(SKILL_DIR, "__init__.py"))
+skill_module = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = skill_module
+_spec.loader.exec_module(skill_module)
+
+
+class TestSearch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.skill = skill_module.create_skill()
+        cls.skill.gui = MagicMock(connected=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.skill.shutdown()
+
+    def test_no_results(self):
+        # youtube found nothing, no network needed
+        self.skill._search_cache = lambda query: []
+        for media_type in (CommonPlayMediaType.GENERIC,
+                           CommonPlayMediaType.MUSIC,
+                           CommonPlayMediaType.PODCAST,
+                           CommonPlayMediaType.DOCUMENTARY,
+                           CommonPlayMediaType.VIDEO):
+            with self.subTest(media_type=media_type):
+                self.assertEqual(
+                    self.skill.search_youtube("rob zombie", media_type), [])
+
+    def test_youtube_removed_from_query(self):
+        # explicit youtube requests search without the youtube keyword
+        queries = []
+        self.skill._search_cache = lambda query: queries.append(query) or []
+        self.skill.search_youtube("rob zombie on youtube",
+                                  CommonPlayMediaType.MUSIC)
+        self.assertEqual(queries, ["rob zombie on"])
+
+
+if __name__ == "__main__":
+    unittest.main()